@@ -1,9 +1,12 @@
-import os, re, time, smtplib, yaml
+import os, re, time, glob, smtplib, asyncio, aiohttp, hashlib, shelve, orjson, yaml
+import numpy as np, onnxruntime as ort, torch
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from serpapi import GoogleSearch
+from contextlib import contextmanager
+from html import escape
 from datetime import datetime
-from sentence_transformers import SentenceTransformer, util
+from transformers import AutoTokenizer
+from sentence_transformers import SentenceTransformer
 
 # --- Load config ---
 with open("config.yaml", "r") as f:
@@ -19,14 +22,85 @@ def _read_txt(path):
     with open(path, "r", encoding="utf-8") as fh:
         return fh.read()
 
-resumes = {
-    "Data Analyst": _read_txt("Data Analyst.txt"),
-    "Application Support Analyst": _read_txt("Application Support Analyst.txt"),
-}
+RESUME_NAMES = ("Data Analyst", "Application Support Analyst")
+resumes = {n: _read_txt(f"{n}.txt") for n in RESUME_NAMES}
+
+# --- Embedding model (INT8 ONNX export of MiniLM for CPU inference) ---
+MODEL_ID  = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_DIR  = "onnx-minilm-int8"
+ONNX_FILE = "model_optimized_quantized.onnx"
+
+def _export_quantized_model(out_dir):
+    """One-time export: FP32 MiniLM -> optimized ONNX graph -> dynamic INT8 (VNNI) ONNX."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTOptimizer, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig, OptimizationConfig
+    ort_model = ORTModelForFeatureExtraction.from_pretrained(MODEL_ID, export=True)
+    ORTOptimizer.from_pretrained(ort_model).optimize(OptimizationConfig(optimization_level=2), save_dir=out_dir)
+    quantizer = ORTQuantizer.from_pretrained(out_dir, file_name="model_optimized.onnx")
+    quantizer.quantize(AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True), save_dir=out_dir)
+    AutoTokenizer.from_pretrained(MODEL_ID).save_pretrained(out_dir)
+
+def _l2_normalize(m):
+    m = np.asarray(m, dtype=np.float32)
+    return m / np.linalg.norm(m, axis=-1, keepdims=True)
+
+class OnnxEncoder:
+    """Drop-in for SentenceTransformer.encode: tokenize, run ONNX, mean-pool, L2-normalize."""
+    def __init__(self, model_dir, max_seq_length=256):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(os.path.join(model_dir, ONNX_FILE),
+                                            providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.max_seq_length = max_seq_length
+
+    def encode(self, texts, convert_to_tensor=False, batch_size=64, normalize_embeddings=True):
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        out = []
+        for i in range(0, len(texts), batch_size):
+            enc = self.tokenizer(texts[i:i+batch_size], padding=True, truncation=True,
+                                 max_length=self.max_seq_length, return_tensors="np")
+            hidden = self.session.run(None, {k: enc[k].astype(np.int64) for k in self.input_names})[0]
+            mask = enc["attention_mask"][..., None].astype(np.float32)
+            emb = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+            out.append(emb)
+        embs = np.concatenate(out)
+        if convert_to_tensor:
+            embs = torch.from_numpy(embs)
+        return embs[0] if single else embs
 
-# --- Embedding model ---
-model = SentenceTransformer("all-MiniLM-L6-v2")
-resume_embeddings = {n: model.encode(t, convert_to_tensor=True) for n, t in resumes.items()}
+# GPU runners get the FP16 PyTorch model; CPU runners use the INT8 ONNX export.
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+ENCODE_BATCH = 128 if DEVICE == "cuda" else 64
+if DEVICE == "cuda":
+    model = SentenceTransformer("all-MiniLM-L6-v2", device=DEVICE).half()
+else:
+    if not os.path.exists(os.path.join(ONNX_DIR, ONNX_FILE)):
+        _export_quantized_model(ONNX_DIR)
+    model = OnnxEncoder(ONNX_DIR)
+
+# Resume embeddings never change during a run: stack them once as a
+# (n_resumes, dim) matrix of unit vectors so scoring is a single GEMM.
+resume_names = list(resumes)
+resume_matrix = _l2_normalize(model.encode([resumes[n] for n in resume_names], normalize_embeddings=True))
+
+# Job texts are capped tighter than resumes: the opening of a posting carries
+# the role signal and attention cost grows with the square of sequence length.
+JOB_MAX_SEQ_LENGTH = 128
+JOB_MAX_CHARS      = 600
+model.max_seq_length = JOB_MAX_SEQ_LENGTH
+
+_text_embeddings = {}
+
+def _encode_texts(texts):
+    """Encode texts, running each distinct string through the model once per process."""
+    todo = [t for t in dict.fromkeys(texts) if t not in _text_embeddings]
+    if todo:
+        _text_embeddings.update(zip(todo, model.encode(todo, batch_size=ENCODE_BATCH, normalize_embeddings=True)))
+    return [_text_embeddings[t] for t in texts]
 
 # -------- Helpers --------
 def extract_job_link(job):
@@ -36,91 +110,269 @@ def extract_job_link(job):
             return opts[0]["link"]
     return job.get("link", "#")
 
+_AGE_RE = re.compile(r"(\d+)\s*(minute|minutes|hour|hours|day|days)")
+_UNIT_HOURS = {"minute": 1/60, "minutes": 1/60, "hour": 1, "hours": 1, "day": 24, "days": 24}
+
 def _parse_age_hours(txt):
     t = (txt or "").lower()
     if "just" in t or "today" in t:
         return 0.0
-    m = re.search(r"(\d+)\s*(minute|minutes|hour|hours|day|days)", t)
+    m = _AGE_RE.search(t)
     if not m: return float("inf")
-    n, unit = int(m.group(1)), m.group(2)
-    return n/60 if "minute" in unit else n if "hour" in unit else n*24
+    return int(m.group(1)) * _UNIT_HOURS[m.group(2)]
 
-def is_fresh(job, max_hours=24):
+def _job_age_hours(job):
     det = job.get("detected_extensions", {}) or {}
-    txt = str(det.get("posted_at") or det.get("posted") or "")
-    return _parse_age_hours(txt) <= max_hours
+    return _parse_age_hours(str(det.get("posted_at") or det.get("posted") or ""))
 
-def _dedup(jobs):
-    seen, out = set(), []
-    for j in jobs:
-        key = (j.get("title",""), j.get("company_name",""), j.get("location",""))
-        if key not in seen:
-            seen.add(key); out.append(j)
-    return out
+def is_fresh(job, max_hours=24):
+    return _job_age_hours(job) <= max_hours
+
+def _canon(s):
+    return s.strip().casefold()
+
+_LOC_SUFFIXES = {
+    "canada", "ca", "on", "ontario", "qc", "quebec", "bc", "british columbia",
+    "ab", "alberta", "mb", "manitoba", "sk", "saskatchewan", "ns", "nova scotia",
+    "nb", "new brunswick", "nl", "newfoundland and labrador", "pe", "prince edward island",
+}
+
+def _normalize_loc(loc):
+    """'Toronto, ON, Canada' and 'Toronto, ON' both become 'toronto'."""
+    parts = [p.strip() for p in (loc or "").casefold().split(",")]
+    while len(parts) > 1 and parts[-1] in _LOC_SUFFIXES:
+        parts.pop()
+    return ", ".join(parts)
+
+def _canonical_key(j):
+    return (_canon(j.get("title","")), _canon(j.get("company_name","")),
+            _normalize_loc(j.get("location","")))
 
 # -------- SerpAPI search --------
-def search_jobs_for_role(role, locations, sleep_sec=1.5):
-    """Fetch freshest available jobs (<=24h); fallback to 3-day window if none."""
-    collected = []
-    for loc in locations:
-        q = f"{role} {loc}"
-        params = {
-            "engine": "google_jobs",
-            "q": q,
-            "hl": "en",
-            "api_key": SERPAPI_KEY,
-            "date_posted": "past_24_hours",
-            "sort_by": "date",
-            "num": 20
-        }
-        results = GoogleSearch(params).get_dict().get("jobs_results", []) or []
-        fresh = [r for r in results if is_fresh(r)]
+SERPAPI_URL     = "https://serpapi.com/search.json"
+MAX_CONCURRENCY = 16
+MAX_RETRIES     = 4
+
+def _search_params(role, loc, date_posted):
+    return {
+        "engine": "google_jobs",
+        "q": f"{role} {loc}",
+        "hl": "en",
+        "api_key": SERPAPI_KEY,
+        "date_posted": date_posted,
+        "sort_by": "date",
+        "num": 20
+    }
+
+async def _serpapi_call(session, sem, params, backoff=1.5):
+    """Fetch one results page; retry 429/5xx and network errors with exponential backoff.
+
+    Any failure that survives the retries (or a non-429 4xx) is logged and treated
+    as an empty page, so one bad query never sinks the whole digest.
+    """
+    for attempt in range(MAX_RETRIES):
+        retry_after = ""
+        try:
+            async with sem:
+                async with session.get(SERPAPI_URL, params=params) as resp:
+                    if 400 <= resp.status < 500 and resp.status != 429:
+                        print(f"⚠️ SerpAPI returned {resp.status} for '{params['q']}'")
+                        return []
+                    if resp.status < 400:
+                        data = orjson.loads(await resp.read())
+                        return data.get("jobs_results", []) or []
+                    retry_after = resp.headers.get("Retry-After", "")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"⚠️ {type(e).__name__} on '{params['q']}' (attempt {attempt + 1})")
+        except orjson.JSONDecodeError:
+            print(f"⚠️ Unparseable SerpAPI response for '{params['q']}'")
+            return []
+        if attempt + 1 < MAX_RETRIES:
+            delay = float(retry_after) if retry_after.isdigit() else backoff * 2 ** attempt
+            await asyncio.sleep(delay)
+    print(f"⚠️ Giving up on '{params['q']}' after {MAX_RETRIES} attempts")
+    return []
+
+def _has_description(job):
+    # title + company alone is too sparse to score against a resume
+    return bool((job.get("description") or "").strip())
+
+def _annotate(jobs):
+    """Attach the dedup key and encoder text once, as jobs enter the pipeline."""
+    for j in jobs:
+        j["_key"] = _canonical_key(j)
+        j["_desc"] = " ".join([j.get("title",""), j.get("company_name",""), j["description"]])[:JOB_MAX_CHARS]
+    return jobs
+
+async def _pages_as_completed(session, sem, role, locations, date_posted):
+    """Yield each location's page as it lands; cancel the rest if the caller stops early."""
+    tasks = [asyncio.create_task(_serpapi_call(session, sem, _search_params(role, loc, date_posted)))
+             for loc in locations]
+    try:
+        for page in asyncio.as_completed(tasks):
+            yield await page
+    finally:
+        for t in tasks:
+            t.cancel()
+
+async def search_jobs_for_role(session, sem, role, locations):
+    """Yield pages of the freshest jobs (<=24h) as they arrive; fallback to 3-day window if none."""
+    found = False
+    async for page in _pages_as_completed(session, sem, role, locations, "past_24_hours"):
+        fresh = [r for r in page if is_fresh(r) and _has_description(r)]
         if fresh:
-            collected.extend(fresh)
-        time.sleep(sleep_sec)
+            found = True
+            yield _annotate(fresh)
 
     # If nothing fresh found, broaden to last 3 days
-    if not collected:
-        for loc in locations:
-            q = f"{role} {loc}"
-            params = {
-                "engine": "google_jobs",
-                "q": q,
-                "hl": "en",
-                "api_key": SERPAPI_KEY,
-                "date_posted": "past_3_days",
-                "sort_by": "date",
-                "num": 20
-            }
-            results = GoogleSearch(params).get_dict().get("jobs_results", []) or []
-            collected.extend(results)
-            time.sleep(sleep_sec)
-
-    return _dedup(collected)
+    if not found:
+        async for page in _pages_as_completed(session, sem, role, locations, "past_3_days"):
+            jobs = [r for r in page if _has_description(r)]
+            if jobs:
+                yield _annotate(jobs)
 
 # -------- Matching --------
-def match_jobs_to_resumes(rolewise_jobs):
-    """Compute match scores for each resume across all role-based job sets."""
-    matches = {n: [] for n in resumes}
-
-    for role, jobs in rolewise_jobs.items():
-        descs, job_refs = [], []
-        for j in jobs:
-            d = " ".join([j.get("title",""), j.get("company_name",""), j.get("description","")]).strip()
-            if d:
-                descs.append(d); job_refs.append(j)
-        if not job_refs:
-            continue
+# Embeddings from different encoders must never be scored together, so the
+# model, backend and job sequence length are part of the cache file name.
+ENCODER_TAG    = f"{MODEL_ID.split('/')[-1]}-{'cuda-fp16' if DEVICE == 'cuda' else 'onnx-int8'}-seq{JOB_MAX_SEQ_LENGTH}"
+CACHE_DIR      = ".cache"
+CACHE_PATH     = os.path.join(CACHE_DIR, f"job_embeddings-{ENCODER_TAG}.db")
+CACHE_TTL_DAYS = 30
+TOP_N = 20
+
+def _job_cache_key(j):
+    raw = "|".join([*j["_key"], j["_desc"]])
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+def _prune_job_cache(max_age_days=CACHE_TTL_DAYS):
+    """Drop caches left by other encoders and entries not seen for max_age_days."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for f in glob.glob(os.path.join(CACHE_DIR, "job_embeddings*")):
+        if not f.startswith(CACHE_PATH):
+            os.remove(f)
+    cutoff = time.time() - max_age_days * 86400
+    with shelve.open(CACHE_PATH) as cache:
+        total = len(cache)
+        live = {k: v for k, v in cache.items() if v[0] >= cutoff}
+    if len(live) == total:
+        return
+    # dbm backends don't shrink on delete; rewrite the survivors into a fresh file.
+    for f in glob.glob(CACHE_PATH + "*"):
+        os.remove(f)
+    with shelve.open(CACHE_PATH) as cache:
+        cache.update(live)
+    print(f"🧹 Pruned {total - len(live)} cached embeddings older than {max_age_days} days")
+
+def _embed_jobs(job_refs):
+    """Return job embeddings, encoding only postings not already in the on-disk cache."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    keys = [_job_cache_key(j) for j, _ in job_refs]
+    now = time.time()
+    with shelve.open(CACHE_PATH) as cache:
+        embs = [e for _, e in (cache.get(k, (None, None)) for k in keys)]
+        misses = [i for i, e in enumerate(embs) if e is None]
+        if misses:
+            new = _encode_texts([job_refs[i][0]["_desc"] for i in misses])
+            for i, e in zip(misses, new):
+                embs[i] = e.astype(np.float16)
+        # (last_seen, embedding): postings still being returned stay cached
+        for k, e in zip(keys, embs):
+            cache[k] = (now, e)
+    print(f"🧠 Encoded {len(misses)} new jobs ({len(keys) - len(misses)} cached)")
+    # float16 storage leaves rows slightly off unit length; renormalize so a
+    # plain dot product against resume_matrix is exactly cosine similarity.
+    return _l2_normalize(np.stack(embs))
+
+async def _embed_stream(queue):
+    """Drain (role, page) items, dedup across roles, and encode full batches in a worker thread."""
+    loop = asyncio.get_running_loop()
+    job_refs, index, pending, chunks = [], {}, [], []
+
+    async def flush(batch):
+        chunks.append(await loop.run_in_executor(None, _embed_jobs, [job_refs[i] for i in batch]))
 
-        job_embs = model.encode(descs, convert_to_tensor=True)
-        for idx, j in enumerate(job_refs):
-            emb = job_embs[idx]
-            for n, res_emb in resume_embeddings.items():
-                score = float(util.cos_sim(res_emb, emb))
-                matches[n].append((score, j, role))
+    while (item := await queue.get()) is not None:
+        role, page = item
+        for j in page:
+            key = j["_key"]
+            if key not in index:
+                index[key] = len(job_refs)
+                pending.append(len(job_refs)); job_refs.append((j, role))
+            elif _job_age_hours(j) < _job_age_hours(job_refs[index[key]][0]):
+                # Same posting seen fresher under another query: keep its details,
+                # reuse the embedding slot of the first copy.
+                job_refs[index[key]] = (j, role)
+        while len(pending) >= ENCODE_BATCH:
+            await flush(pending[:ENCODE_BATCH])
+            pending = pending[ENCODE_BATCH:]
+    if pending:
+        await flush(pending)
+    return job_refs, (np.concatenate(chunks) if chunks else None)
+
+async def collect_and_embed(roles, locations):
+    """Fetch every (role, location) concurrently and encode pages as they land.
+
+    Producers push pages onto a queue while the consumer encodes in a thread,
+    so wall time is roughly max(fetch, encode) rather than their sum.
+    """
+    queue = asyncio.Queue()
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def produce(session, role):
+        found = 0
+        async for page in search_jobs_for_role(session, sem, role, locations):
+            found += len(page)
+            await queue.put((role, page))
+        print(f"{role}: {found} jobs found (fresh or last 3 days)")
+
+    async def produce_all():
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+                results = await asyncio.gather(*(produce(session, role) for role in roles),
+                                               return_exceptions=True)
+            # A failed role only loses its own pages; the rest still make the digest.
+            for role, res in zip(roles, results):
+                if isinstance(res, Exception):
+                    print(f"⚠️ {role}: search failed ({type(res).__name__}: {res})")
+        finally:
+            await queue.put(None)
+
+    producer = asyncio.create_task(produce_all())
+    try:
+        job_refs, job_matrix = await _embed_stream(queue)
+    except BaseException:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        raise
+    await producer
+    return job_refs, job_matrix
+
+def match_jobs_to_resumes(job_refs, job_matrix):
+    """Return each resume's TOP_N (score, job, role) matches, best first."""
+    matches = {n: [] for n in resume_names}
+    if not job_refs:
+        return matches
+
+    scores = resume_matrix @ job_matrix.T
+
+    # Only the top TOP_N per resume are ever shown: argpartition picks them
+    # in O(n), then just those few are sorted.
+    for r, n in enumerate(resume_names):
+        row = scores[r]
+        idx = np.argpartition(-row, TOP_N)[:TOP_N] if len(row) > TOP_N else np.arange(len(row))
+        idx = idx[np.argsort(-row[idx])]
+        matches[n] = [(float(row[i]),) + job_refs[i] for i in idx]
     return matches
 
 # -------- Email --------
+_LINK_ATTRS = "target='_blank' style='color:#1a73e8;text-decoration:none;'"
+_LIST_CLOSE = "</ul><br>"
+_LI_TMPL = (
+    "<li><b>{title}</b> at {company} ({location}) – <b>{pct}%</b> match "
+    "<i>({role})</i><br>"
+    "<a href='{link}' " + _LINK_ATTRS + ">🔗 View Job</a></li>"
+)
+
 def build_email(matches):
     today = datetime.now().strftime('%b %d, %Y')
     html = [f"<html><body><h2>🧭 AI-Powered Job Digest ({today})</h2>"]
@@ -129,50 +381,49 @@ def build_email(matches):
         if not jobs:
             html.append("<p>No fresh jobs today.</p>")
             continue
-        top = sorted(jobs, key=lambda x: x[0], reverse=True)[:20]
         html.append("<ul>")
-        for score, j, role in top:
-            html.append(
-                f"<li><b>{j.get('title','')}</b> at {j.get('company_name','')} "
-                f"({j.get('location','')}) – <b>{int(score*100)}%</b> match "
-                f"<i>({role})</i><br>"
-                f"<a href='{extract_job_link(j)}' target='_blank' "
-                f"style='color:#1a73e8;text-decoration:none;'>🔗 View Job</a></li>"
-            )
-        html.append("</ul><br>")
+        for score, j, role in jobs:
+            # Job fields come straight from SerpAPI; escape before they hit the markup.
+            html.append(_LI_TMPL.format(
+                title=escape(j.get("title","")), company=escape(j.get("company_name","")),
+                location=escape(j.get("location","")), pct=int(score*100),
+                role=escape(role), link=escape(extract_job_link(j), quote=True),
+            ))
+        html.append(_LIST_CLOSE)
     html.append("</body></html>")
     return "".join(html)
 
-def send_email(subject, html_content):
+@contextmanager
+def _smtp_session():
+    """One logged-in implicit-TLS connection; reuse it for every message in a run."""
+    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as s:
+        s.login(EMAIL_USER, EMAIL_PASS)
+        yield s
+
+def send_email(session, subject, html_content):
     msg = MIMEMultipart("alternative")
     msg["Subject"], msg["From"], msg["To"] = subject, EMAIL_USER, EMAIL_TO
     msg.attach(MIMEText(html_content, "html"))
-    with smtplib.SMTP("smtp.gmail.com", 587) as s:
-        s.starttls(); s.login(EMAIL_USER, EMAIL_PASS); s.send_message(msg)
+    session.send_message(msg)
     print(f"✅ Email sent to {EMAIL_TO}")
 
 # -------- Main --------
 def main():
-    roles = []
-    seen = set()
+    unique_roles = {}
     for r in config["roles"]:
-        rl = r.strip()
-        if rl.lower() not in seen:
-            seen.add(rl.lower()); roles.append(rl)
-
-    rolewise_jobs = {}
-    for role in roles:
-        fresh = search_jobs_for_role(role, config["locations"])
-        print(f"{role}: {len(fresh)} jobs found (fresh or last 3 days)")
-        rolewise_jobs[role] = fresh
-        time.sleep(1)
-
-    matches = match_jobs_to_resumes(rolewise_jobs)
+        unique_roles.setdefault(_canon(r), r.strip())
+    roles = list(unique_roles.values())
+
+    _prune_job_cache()
+    job_refs, job_matrix = asyncio.run(collect_and_embed(roles, config["locations"]))
+    matches = match_jobs_to_resumes(job_refs, job_matrix)
     html = build_email(matches)
-    send_email(
-        f"🧭 {len(roles)}-Role Job Digest – {datetime.now():%b %d, %Y}",
-        html
-    )
+    with _smtp_session() as session:
+        send_email(
+            session,
+            f"🧭 {len(roles)}-Role Job Digest – {datetime.now():%b %d, %Y}",
+            html
+        )
 
 if __name__ == "__main__":
     main()